@@ -10,6 +10,7 @@ Description: Code for manual control of leader drone.
 
 import time
 import math
+import threading
 import cosysairsim as airsim
 import ctypes
 
@@ -22,6 +23,13 @@ LEADER_NAME    = "Leader"
 # Control period (increase to reduce command jitter)
 DT = 0.05  # 20 Hz
 
+# Command coalescing: a command that is not a turn while moving is held for
+# CMD_HOLD (one control period plus one skipped tick and a small margin) and is
+# not re-sent while it is still active and the targets moved less than CMD_EPSILON
+CMD_MARGIN  = 0.02               # s
+CMD_HOLD    = 2 * DT + CMD_MARGIN  # s
+CMD_EPSILON = 0.01               # m/s (deg/s for yaw rate)
+
 # Leader max speed / angular speed
 MAX_LEADER_SPEED_XY = 4.0   # m/s
 MAX_LEADER_SPEED_Z  = 2.0   # m/s
@@ -35,27 +43,86 @@ DECEL_Z    = 2.5   # m/s^2
 ACCEL_YAW  = 180.0 # deg/s^2
 DECEL_YAW  = 220.0 # deg/s^2
 
-# Smoothing (small amount to remove minor jitter)
-SMOOTH_ALPHA        = 0.2  # 0~1, lower = smoother
+# Slew-rate limits
 SLEW_XY             = 3.0   # m/s^2
 SLEW_Z              = 2.0   # m/s^2
 SLEW_YAW            = 180.0 # deg/s^2
 
-# WinAPI keyboard state
+# WinAPI keyboard state (prototype set once so ctypes skips per-call argument inference)
 user32 = ctypes.windll.user32
+_GetAsyncKeyState = user32.GetAsyncKeyState
+_GetAsyncKeyState.argtypes = [ctypes.c_int]
+_GetAsyncKeyState.restype = ctypes.c_short
+
+# Virtual key codes
 VK_ESCAPE = 0x1B  # ESC
+VK_A = 0x41
+VK_D = 0x44
+VK_I = 0x49
+VK_J = 0x4A
+VK_K = 0x4B
+VK_L = 0x4C
+VK_P = 0x50
+VK_S = 0x53
+VK_U = 0x55
+VK_W = 0x57
+
+# Key mask bits (one per tracked key) filled by the keyboard polling thread
+BIT_ESCAPE = 1 << 0
+BIT_W      = 1 << 1
+BIT_S      = 1 << 2
+BIT_A      = 1 << 3
+BIT_D      = 1 << 4
+BIT_I      = 1 << 5
+BIT_U      = 1 << 6
+BIT_J      = 1 << 7
+BIT_L      = 1 << 8
+BIT_K      = 1 << 9
+BIT_P      = 1 << 10
+KEY_BITS = (
+    (VK_ESCAPE, BIT_ESCAPE),
+    (VK_W, BIT_W), (VK_S, BIT_S),
+    (VK_A, BIT_A), (VK_D, BIT_D),
+    (VK_I, BIT_I), (VK_U, BIT_U),
+    (VK_J, BIT_J), (VK_L, BIT_L),
+    (VK_K, BIT_K), (VK_P, BIT_P),
+)
+
+# Windows multimedia timer (timeBeginPeriod(1) gives time.sleep 1 ms granularity)
+winmm = ctypes.windll.winmm
+
+# Keyboard polling period (much shorter than DT so brief taps are not missed)
+KEY_POLL_PERIOD = 0.001  # s
 
 
 #-----Keyboard Input Functions-----
 
-def is_pressed_char(ch: str) -> bool:
-    """Check if a character key is pressed (case insensitive)"""
-    vk = ord(ch.upper())
-    return (user32.GetAsyncKeyState(vk) & 0x8000) != 0
+def poll_key_mask() -> int:
+    """Read all tracked keys into one bitmask"""
+    mask = 0
+    for vk, bit in KEY_BITS:
+        if _GetAsyncKeyState(vk) & 0x8000:
+            mask |= bit
+    return mask
+
+def key_polling_loop(latched, lock, stop_event):
+    """
+    Poll the keyboard at ~1 kHz and OR every pressed key into latched[0],
+    so presses shorter than one control period still reach the control loop
+    """
+    while not stop_event.is_set():
+        mask = poll_key_mask()
+        if mask:
+            with lock:
+                latched[0] |= mask
+        time.sleep(KEY_POLL_PERIOD)
 
-def is_pressed_vkey(vk: int) -> bool:
-    """Check if a virtual key is pressed"""
-    return (user32.GetAsyncKeyState(vk) & 0x8000) != 0
+def take_key_mask(latched, lock) -> int:
+    """Return the keys pressed since the last call and clear the latch"""
+    with lock:
+        mask = latched[0]
+        latched[0] = 0
+    return mask
 
 
 #-----Utility Functions-----
@@ -64,6 +131,15 @@ def clamp(x, min_val, max_val):
     """Clamp x to the range [min_val, max_val]"""
     return max(min(x, max_val), min_val)
 
+def command_changed(cmd, last_cmd, eps):
+    """Check if any component of cmd differs from last_cmd by at least eps"""
+    if last_cmd is None:
+        return True
+    for new, old in zip(cmd, last_cmd):
+        if abs(new - old) >= eps:
+            return True
+    return False
+
 def quat_to_yaw(q):
     """
     Convert Cosys-AirSim's Quaternionr to yaw (radians)
@@ -79,15 +155,22 @@ def quat_to_yaw(q):
     yaw = math.atan2(siny_cosp, cosy_cosp)
     return yaw
 
+def integrate_axis(target, direction, accel, decel, max_val, dt):
+    """
+    Ramp a target command: accelerate along direction (-1, 0, 1) while a key
+    is held, otherwise decelerate toward zero without overshooting
+    """
+    if direction:
+        return clamp(target + direction * accel * dt, -max_val, max_val)
+    if target:
+        return target - math.copysign(min(decel * dt, abs(target)), target)
+    return 0.0
+
 def slew_limit(target, current, max_rate, dt):
     """Simple slew-rate limiter"""
     delta = clamp(target - current, -max_rate * dt, max_rate * dt)
     return current + delta
 
-def low_pass_filter(target, current, alpha):
-    """Simple low-pass filter"""
-    return current + alpha * (target - current)
-
 
 def enable_api_control(client, vehicle_name):
     """Enable API control for a given vehicle"""
@@ -129,106 +212,121 @@ def main():
     has_taken_off = True
     running = True
 
-    # Smoothed command states
-    sm_vx = 0.0
-    sm_vy = 0.0
-    sm_vz = 0.0
-    sm_yaw_rate = 0.0
-
-    # Integrating target states (accelerate while pressed)
+    # Integrating target states (accelerate while pressed); already ramp-limited,
+    # so they are sent as-is without extra smoothing
     tgt_vx = 0.0
     tgt_vy = 0.0
     tgt_vz = 0.0
     tgt_yaw_rate = 0.0
 
-    # Control loop
+    # Loop-invariant command arguments (yaw_mode is updated in place each tick)
+    yaw_mode = airsim.YawMode(is_rate=True, yaw_or_rate=0.0)
+    drivetrain = airsim.DrivetrainType.MaxDegreeOfFreedom
+    move_by_velocity = client.moveByVelocityBodyFrameAsync
+    leader_name = LEADER_NAME
+
+    # Last command sent, its pending RPC future and when it stops being active
+    last_cmd = None
+    last_future = None
+    cmd_expiry = 0.0
+
+    # Keyboard polling thread (latches presses between control ticks)
+    key_latched = [0]
+    key_lock = threading.Lock()
+    key_stop = threading.Event()
+    key_thread = threading.Thread(
+        target=key_polling_loop, args=(key_latched, key_lock, key_stop), daemon=True
+    )
+    key_thread.start()
+
+    # Control loop (paced against absolute deadlines so overruns don't accumulate drift)
+    winmm.timeBeginPeriod(1)
+    next_t = time.perf_counter() + DT
     try:
         while running:
-            t0 = time.time()
+            # -------- Keys pressed since the last tick --------
+            keys = take_key_mask(key_latched, key_lock)
+
             # -------- Exit check --------
-            if is_pressed_vkey(VK_ESCAPE):
+            if keys & BIT_ESCAPE:
                 running = False
                 break
 
+            key_w = (keys & BIT_W) != 0
+            key_s = (keys & BIT_S) != 0
+            key_a = (keys & BIT_A) != 0
+            key_d = (keys & BIT_D) != 0
+            key_i = (keys & BIT_I) != 0
+            key_u = (keys & BIT_U) != 0
+            key_j = (keys & BIT_J) != 0
+            key_l = (keys & BIT_L) != 0
+            key_k = (keys & BIT_K) != 0
+            key_p = (keys & BIT_P) != 0
+
             # ------- Accel/decel based on key press (hold to accelerate) --------
+            # direction: +1 / -1 while one key of the pair is held, 0 for none or both
             # X forward/back
-            if is_pressed_char('W') and not is_pressed_char('S'):
-                tgt_vx = clamp(tgt_vx + ACCEL_XY * DT, -MAX_LEADER_SPEED_XY, MAX_LEADER_SPEED_XY)
-            elif is_pressed_char('S') and not is_pressed_char('W'):
-                tgt_vx = clamp(tgt_vx - ACCEL_XY * DT, -MAX_LEADER_SPEED_XY, MAX_LEADER_SPEED_XY)
-            else:
-                # decelerate toward 0
-                if tgt_vx > 0:
-                    tgt_vx = max(0.0, tgt_vx - DECEL_XY * DT)
-                elif tgt_vx < 0:
-                    tgt_vx = min(0.0, tgt_vx + DECEL_XY * DT)
-
+            tgt_vx = integrate_axis(tgt_vx, key_w - key_s, ACCEL_XY, DECEL_XY, MAX_LEADER_SPEED_XY, DT)
             # Y left/right (body frame)
-            if is_pressed_char('D') and not is_pressed_char('A'):
-                tgt_vy = clamp(tgt_vy + ACCEL_XY * DT, -MAX_LEADER_SPEED_XY, MAX_LEADER_SPEED_XY)
-            elif is_pressed_char('A') and not is_pressed_char('D'):
-                tgt_vy = clamp(tgt_vy - ACCEL_XY * DT, -MAX_LEADER_SPEED_XY, MAX_LEADER_SPEED_XY)
-            else:
-                if tgt_vy > 0:
-                    tgt_vy = max(0.0, tgt_vy - DECEL_XY * DT)
-                elif tgt_vy < 0:
-                    tgt_vy = min(0.0, tgt_vy + DECEL_XY * DT)
-
+            tgt_vy = integrate_axis(tgt_vy, key_d - key_a, ACCEL_XY, DECEL_XY, MAX_LEADER_SPEED_XY, DT)
             # Z up/down (NED: z positive down)
-            if is_pressed_char('I') and not is_pressed_char('U'):
-                tgt_vz = clamp(tgt_vz + ACCEL_Z * DT, -MAX_LEADER_SPEED_Z, MAX_LEADER_SPEED_Z)
-            elif is_pressed_char('U') and not is_pressed_char('I'):
-                tgt_vz = clamp(tgt_vz - ACCEL_Z * DT, -MAX_LEADER_SPEED_Z, MAX_LEADER_SPEED_Z)
-            else:
-                if tgt_vz > 0:
-                    tgt_vz = max(0.0, tgt_vz - DECEL_Z * DT)
-                elif tgt_vz < 0:
-                    tgt_vz = min(0.0, tgt_vz + DECEL_Z * DT)
-
+            tgt_vz = integrate_axis(tgt_vz, key_i - key_u, ACCEL_Z, DECEL_Z, MAX_LEADER_SPEED_Z, DT)
             # Yaw rate (deg/s)
-            if is_pressed_char('L') and not is_pressed_char('J'):
-                tgt_yaw_rate = clamp(tgt_yaw_rate + ACCEL_YAW * DT, -YAW_RATE_DEG, YAW_RATE_DEG)
-            elif is_pressed_char('J') and not is_pressed_char('L'):
-                tgt_yaw_rate = clamp(tgt_yaw_rate - ACCEL_YAW * DT, -YAW_RATE_DEG, YAW_RATE_DEG)
-            else:
-                if tgt_yaw_rate > 0:
-                    tgt_yaw_rate = max(0.0, tgt_yaw_rate - DECEL_YAW * DT)
-                elif tgt_yaw_rate < 0:
-                    tgt_yaw_rate = min(0.0, tgt_yaw_rate + DECEL_YAW * DT)
+            tgt_yaw_rate = integrate_axis(tgt_yaw_rate, key_l - key_j, ACCEL_YAW, DECEL_YAW, YAW_RATE_DEG, DT)
 
             # K: Return to zero yaw rate immediately
-            if is_pressed_char('K'):
+            if key_k:
                 tgt_yaw_rate = 0.0
 
             # P: Land
-            if is_pressed_char('P'):
+            if key_p:
                 if has_taken_off:
                     print("Landing LEADER drone...")
                     client.landAsync(vehicle_name=LEADER_NAME).join()
                     has_taken_off = False
                     print("LEADER Landing done.")
 
-            # ---- Small smoothing to reduce jitter ----
-            sm_vx = low_pass_filter(tgt_vx, sm_vx, SMOOTH_ALPHA)
-            sm_vy = low_pass_filter(tgt_vy, sm_vy, SMOOTH_ALPHA)
-            sm_vz = low_pass_filter(tgt_vz, sm_vz, SMOOTH_ALPHA)
-            sm_yaw_rate = low_pass_filter(tgt_yaw_rate, sm_yaw_rate, SMOOTH_ALPHA)
-
             # ---- Send one combined motion command ----
-            yaw_mode = airsim.YawMode(is_rate=True, yaw_or_rate=sm_yaw_rate)
-            client.moveByVelocityBodyFrameAsync(
-                sm_vx, sm_vy, sm_vz, DT,
-                drivetrain=airsim.DrivetrainType.MaxDegreeOfFreedom,
-                yaw_mode=yaw_mode,
-                vehicle_name=LEADER_NAME
-            ).join()
-
-            # Keep loop rate stable
-            elapsed = time.time() - t0
-            sleep_time = max(0.0, DT - elapsed)
-            time.sleep(sleep_time)
+            # Not joined right away (that would tie the loop rate to the RPC
+            # round-trip). Instead the previous command's future is joined once the
+            # new one is sent: AirSim cancels the old task, so the join returns
+            # almost at once and its reply is read instead of piling up.
+            # Skipped while the previous command still covers this tick with
+            # (nearly) the same targets, except when turning while moving: the body
+            # frame velocity is fixed to world frame with the yaw at arrival, so
+            # it has to be refreshed every tick as the heading changes.
+            cmd = (tgt_vx, tgt_vy, tgt_vz, tgt_yaw_rate)
+            t_cmd = time.perf_counter()
+            coalescable = tgt_yaw_rate == 0.0 or (tgt_vx == 0.0 and tgt_vy == 0.0)
+            if (not coalescable or t_cmd + DT > cmd_expiry
+                    or command_changed(cmd, last_cmd, CMD_EPSILON)):
+                duration = CMD_HOLD if coalescable else DT
+                yaw_mode.yaw_or_rate = tgt_yaw_rate
+                future = move_by_velocity(
+                    tgt_vx, tgt_vy, tgt_vz, duration,
+                    drivetrain=drivetrain,
+                    yaw_mode=yaw_mode,
+                    vehicle_name=leader_name
+                )
+                if last_future is not None:
+                    last_future.join()
+                last_future = future
+                last_cmd = cmd
+                cmd_expiry = t_cmd + duration
+
+            # Keep loop rate stable: sleep until the next deadline
+            now = time.perf_counter()
+            if now < next_t:
+                time.sleep(next_t - now)
+            next_t += DT
+            if now > next_t:
+                # Overran by more than a period (e.g. landing): resync instead of catching up
+                next_t = now + DT
 
     finally:
+        winmm.timeEndPeriod(1)
+        key_stop.set()
+        key_thread.join(timeout=0.5)
         print("\nStopping, landing LEADER drone...")
         try:
             client.hoverAsync(vehicle_name=LEADER_NAME)
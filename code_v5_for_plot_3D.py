@@ -12,8 +12,10 @@ Description: 3D real-time plotting of leader drone trajectory with gradient colo
 
 import os
 import time
-import math
+import ctypes
 import glob
+import threading
+from collections import deque
 from datetime import datetime
 
 import numpy as np
@@ -40,27 +42,24 @@ LEADER_NAME = "Leader"
 DT = 0.05  # 20Hz
 RUNTIME_LIMIT_SEC = None  # set number (e.g., 120) to auto-stop; None for Ctrl+C
 GIF_SPEED_MULTIPLIER = 3  # GIF speed relative to real-time
+BUFFER_INIT_SAMPLES = 4096  # preallocated samples per buffer (doubled when full)
+TELEMETRY_PERIOD = 0.002  # telemetry thread re-check interval while its last sample is untaken (s)
+TELEMETRY_LEAD = 0.015  # fetch the pose this long before the plot tick that uses it (~ RPC round-trip, s)
+FULL_REDRAW_EVERY = 20  # frames between full redraws (refreshes colorbar); others are blitted
+DISPLAY_EVERY = 3  # frames between live window updates (sampling still runs every frame)
+AXIS_UPDATE_TOL = 0.05  # m; axis limits are only moved when the trajectory grows past them by more than this
 
 # -------------------- Utils --------------------
 
-def quat_to_rpy(q: airsim.Quaternionr):
-    # Convert quaternion to roll-pitch-yaw (radians)
-    w = q.w_val
-    x = q.x_val
-    y = q.y_val
-    z = q.z_val
-    # roll (x-axis rotation)
-    sinr_cosp = 2 * (w * x + y * z)
-    cosr_cosp = 1 - 2 * (x * x + y * y)
-    roll = math.atan2(sinr_cosp, cosr_cosp)
-    # pitch (y-axis rotation)
-    sinp = 2 * (w * y - z * x)
-    pitch = math.asin(max(-1.0, min(1.0, sinp)))
-    # yaw (z-axis rotation)
-    siny_cosp = 2 * (w * z + x * y)
-    cosy_cosp = 1 - 2 * (y * y + z * z)
-    yaw = math.atan2(siny_cosp, cosy_cosp)
-    return roll, pitch, yaw
+def quat_array_to_rpy_deg(q: np.ndarray):
+    # Convert an (n, 4) array of (w, x, y, z) quaternion rows to roll-pitch-yaw.
+    # Returns unwrapped roll, pitch, yaw in degrees.
+    w, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    yy = y * y
+    roll = np.arctan2(2.0 * (w * x + y * z), 1.0 - 2.0 * (x * x + yy))
+    pitch = np.arcsin(np.clip(2.0 * (w * y - z * x), -1.0, 1.0))
+    yaw = np.arctan2(2.0 * (w * z + x * y), 1.0 - 2.0 * (yy + z * z))
+    return np.degrees(np.unwrap(roll)), np.degrees(np.unwrap(pitch)), np.degrees(np.unwrap(yaw))
 
 
 def ensure_output_dir(base_dir: str) -> str:
@@ -82,11 +81,36 @@ def ensure_output_dir(base_dir: str) -> str:
     return out_dir
 
 
-def build_segments_3d(xs, ys, zs):
-    if len(xs) < 2:
-        return np.empty((0, 2, 3))
-    pts = np.column_stack([xs, ys, zs])
-    return np.concatenate([pts[:-1, None, :], pts[1:, None, :]], axis=1)
+def grow_buffer(buf: np.ndarray) -> np.ndarray:
+    # Double capacity along the sample axis, keeping existing contents
+    new_buf = np.empty((buf.shape[0] * 2,) + buf.shape[1:], dtype=buf.dtype)
+    new_buf[:buf.shape[0]] = buf
+    return new_buf
+
+
+def telemetry_producer(latest: deque, fetch_at: list, stop_event: threading.Event):
+    # Poll leader pose in a background thread so the RPC overlaps with drawing.
+    # Only position + orientation are needed, so fetch the pose rather than the
+    # full multirotor state (much smaller RPC payload).
+    # Uses its own client (the RPC client is not safe to share across threads);
+    # `latest` has maxlen=1; a new pose is only fetched once the plot loop has
+    # taken the previous one (so no RPC is spent on samples that would be dropped),
+    # and not before fetch_at[0], which the plot loop sets to just before its next
+    # tick so the sample it consumes is fresh.
+    try:
+        client = airsim.MultirotorClient()
+        while not stop_event.is_set():
+            if latest:
+                time.sleep(TELEMETRY_PERIOD)
+                continue
+            wait = fetch_at[0] - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+                continue
+            pose = client.simGetVehiclePose(vehicle_name=LEADER_NAME)
+            latest.append((time.perf_counter(), pose))
+    except Exception as e:
+        print('Telemetry thread stopped:', e)
 
 
 # -------------------- Main --------------------
@@ -102,15 +126,19 @@ def main():
     client.enableApiControl(True, LEADER_NAME)
     client.armDisarm(True, LEADER_NAME)
 
-    t0_global = time.time()
+    t0_global = time.perf_counter()
+
+    # Preallocated sample buffers; first n rows are valid
+    n = 0
+    t_arr = np.empty(BUFFER_INIT_SAMPLES, dtype=np.float64)
+    pts = np.empty((BUFFER_INIT_SAMPLES, 3), dtype=np.float32)  # x, y, z (ENU: z up positive = -NED z)
+    quats = np.empty((BUFFER_INIT_SAMPLES, 4), dtype=np.float64)  # raw w, x, y, z; converted at save time
+    segs = np.empty((BUFFER_INIT_SAMPLES, 2, 3), dtype=np.float32)  # segment i joins pts[i] and pts[i + 1]
 
-    t_list = []
-    xs, ys, zs = [], [], []           # NED raw (z down positive)
-    z_plot = []                       # ENU for plotting (z up positive) = -zs
-    rolls, pitches, yaws = [], [], []
+    # Running bounds of the ENU trajectory (for autoscale)
+    xmin = xmax = ymin = ymax = zmin = zmax = None
 
-    # Realtime 3D plot
-    plt.ion()
+    # Realtime 3D plot (not interactive mode: redraws are driven explicitly below)
     fig = plt.figure(figsize=(8, 7))
     ax = fig.add_subplot(111, projection='3d')
     ax.set_title('Leader 3D Trajectory')
@@ -123,60 +151,174 @@ def main():
     cmap = cm.plasma
     norm = mcolors.Normalize(vmin=0, vmax=1)
     lc3d = Line3DCollection([], cmap=cmap, norm=norm, linewidth=2)
+    lc3d.set_animated(True)  # drawn by blitting, skipped by full redraws
     ax.add_collection(lc3d)
     cb = fig.colorbar(lc3d, ax=ax, pad=0.1)
     cb.set_label('Time (s)')
 
-    frames = []
+    # Blitting: cache the axes background after every full draw (including
+    # resize / mouse rotation) and draw the trajectory on top of it
+    background = None
+
+    def on_draw(event):
+        nonlocal background
+        background = fig.canvas.copy_from_bbox(ax.bbox)
+        lc3d.do_3d_projection()
+        ax.draw_artist(lc3d)
+
+    draw_cid = fig.canvas.mpl_connect('draw_event', on_draw)
+    plt.show(block=False)
+    fig.canvas.draw()
+    fig.canvas.flush_events()
+    axis_bounds = None  # (xmin, xmax, ymin, ymax, zmin, zmax) the axis limits were last set from
+    full_redraw_pending = True
+
+    def update_trajectory():
+        # Push the sampled path into the gradient 3D line (use ENU z for plotting)
+        lc3d.set_segments(segs[:max(n - 1, 0)])  # view, segments are appended per sample
+        if n > 1:
+            lc3d.set_array(t_arr[1:n])
+            lc3d.set_norm(mcolors.Normalize(vmin=0.0, vmax=max(1e-6, t_arr[n - 1])))
+
+    # Stream GIF frames to disk instead of keeping them all in memory.
+    # Writing every GIF_SPEED_MULTIPLIER-th frame at real-time fps gives the sped-up playback.
+    gif_path = os.path.join(out_dir, 'trajectory_3d.gif')
+    gif_fps = max(1, int(round(1/DT)))
+    gif_writer = None
+    gif_frames = 0
+    if IMAGEIO_AVAILABLE:
+        try:
+            # Legacy GIF-PIL writer encodes and writes each frame on append_data
+            # (the default pillow plugin would hold every frame until close())
+            gif_writer = imageio.get_writer(gif_path, format='GIF-PIL', mode='I', fps=gif_fps)
+        except Exception as e:
+            print('Failed to open GIF writer:', e)
+    frame_idx = 0
+
+    # Telemetry producer thread
+    latest = deque(maxlen=1)
+    fetch_at = [0.0]  # perf_counter time the producer may fetch the next pose
+    stop_event = threading.Event()
+    producer = threading.Thread(target=telemetry_producer, args=(latest, fetch_at, stop_event), daemon=True)
+    producer.start()
+
+    # Finer sleep granularity on Windows (default timer tick is ~15.6 ms)
+    if os.name == 'nt':
+        ctypes.windll.winmm.timeBeginPeriod(1)
+    next_t = time.perf_counter() + DT
 
     print('Start plotting 3D trajectory... Press Ctrl+C to stop.')
     try:
         while True:
-            now = time.time()
+            now = time.perf_counter()
             if RUNTIME_LIMIT_SEC is not None and (now - t0_global) >= RUNTIME_LIMIT_SEC:
                 break
 
-            state = client.getMultirotorState(vehicle_name=LEADER_NAME)
-            pos = state.kinematics_estimated.position
-            orient = state.kinematics_estimated.orientation
-
-            t_list.append(now - t0_global)
-            xs.append(pos.x_val)
-            ys.append(pos.y_val)
-            zs.append(pos.z_val)        # NED raw
-            z_plot.append(-pos.z_val)   # ENU for plotting
-            r, p, y = quat_to_rpy(orient)
-            rolls.append(r)
-            pitches.append(p)
-            yaws.append(y)
-
-            # Update gradient 3D path (use ENU z for plotting)
-            segments = build_segments_3d(xs, ys, z_plot)
-            lc3d.set_segments(segments)
-            if len(xs) > 1:
-                seg_times = np.array(t_list[1:])
-                lc3d.set_array(seg_times)
-                lc3d.set_norm(mcolors.Normalize(vmin=0.0, vmax=max(1e-6, t_list[-1])))
+            # Consume the newest sample; wait if the producer has nothing new yet
+            try:
+                sample_time, pose = latest.pop()
+            except IndexError:
+                if not producer.is_alive():
+                    break
+                time.sleep(0.001)
+                continue
+            pos = pose.position
+            orient = pose.orientation
+
+            if n == t_arr.shape[0]:
+                t_arr = grow_buffer(t_arr)
+                pts = grow_buffer(pts)
+                quats = grow_buffer(quats)
+                segs = grow_buffer(segs)
+
+            px, py, pz = pos.x_val, pos.y_val, -pos.z_val  # ENU for plotting
+            t_arr[n] = sample_time - t0_global
+            pts[n] = (px, py, pz)
+            quats[n] = (orient.w_val, orient.x_val, orient.y_val, orient.z_val)
+            if n > 0:
+                segs[n - 1] = pts[n - 1:n + 1]  # append the one new segment
+            n += 1
+
+            # Update running bounds with the new sample only
+            if xmin is None:
+                xmin = xmax = px
+                ymin = ymax = py
+                zmin = zmax = pz
+            else:
+                if px < xmin: xmin = px
+                elif px > xmax: xmax = px
+                if py < ymin: ymin = py
+                elif py > ymax: ymax = py
+                if pz < zmin: zmin = pz
+                elif pz > zmax: zmax = pz
 
             # Autoscale axes to fit data (with margin) using ENU z
+            # Only touch the limits when the bounding box actually grew, since every
+            # set_*lim3d call forces a new 3D projection and a full redraw
             margin = 1.5
-            ax.set_xlim3d(min(xs) - margin, max(xs) + margin)
-            ax.set_ylim3d(min(ys) - margin, max(ys) + margin)
-            ax.set_zlim3d(min(z_plot) - margin, max(z_plot) + margin)
-
-            plt.draw()
-            plt.pause(DT)
-
-            # Save frame for GIF
-            fig.canvas.draw()
-            rgba = np.asarray(fig.canvas.buffer_rgba())
-            image = rgba[:, :, :3].copy()
-            frames.append(image)
+            bounds_dirty = (
+                axis_bounds is None
+                or xmin < axis_bounds[0] - AXIS_UPDATE_TOL or xmax > axis_bounds[1] + AXIS_UPDATE_TOL
+                or ymin < axis_bounds[2] - AXIS_UPDATE_TOL or ymax > axis_bounds[3] + AXIS_UPDATE_TOL
+                or zmin < axis_bounds[4] - AXIS_UPDATE_TOL or zmax > axis_bounds[5] + AXIS_UPDATE_TOL
+            )
+            if bounds_dirty:
+                axis_bounds = (xmin, xmax, ymin, ymax, zmin, zmax)
+                ax.set_xlim3d(xmin - margin, xmax + margin)
+                ax.set_ylim3d(ymin - margin, ymax + margin)
+                ax.set_zlim3d(zmin - margin, zmax + margin)
+                full_redraw_pending = True
+            if frame_idx % FULL_REDRAW_EVERY == 0:
+                full_redraw_pending = True
+
+            # Render only on frames that are shown in the window or captured for the GIF;
+            # the GUI (blit + event processing) is only touched every DISPLAY_EVERY frames
+            show_frame = frame_idx % DISPLAY_EVERY == 0
+            capture_frame = gif_writer is not None and frame_idx % GIF_SPEED_MULTIPLIER == 0
+            if show_frame or capture_frame:
+                update_trajectory()
+                # Full redraw only when the axes changed (or periodically for the colorbar),
+                # otherwise restore the cached background and redraw just the trajectory
+                if full_redraw_pending:
+                    fig.canvas.draw()  # on_draw re-caches background and draws lc3d
+                    full_redraw_pending = False
+                else:
+                    fig.canvas.restore_region(background)
+                    lc3d.do_3d_projection()
+                    ax.draw_artist(lc3d)
+                    if show_frame:
+                        fig.canvas.blit(ax.bbox)
+            if show_frame:
+                fig.canvas.flush_events()
+
+            # Save every GIF_SPEED_MULTIPLIER-th frame for GIF (canvas buffer is already up to date);
+            # done before the sleep so encoding does not delay taking the next sample
+            if capture_frame:
+                rgba = np.asarray(fig.canvas.buffer_rgba())
+                gif_writer.append_data(rgba[:, :, :3])  # encoded on append, no copy needed
+                gif_frames += 1
+            frame_idx += 1
+
+            # Keep loop rate: sleep until the next deadline, resync after an overrun
+            now = time.perf_counter()
+            if now < next_t:
+                time.sleep(next_t - now)
+            next_t += DT
+            if now > next_t:
+                next_t = now + DT
+            # The sample taken now was fetched for this tick; the next one is taken when
+            # the sleep ending at next_t returns, so have it fetched just before that
+            fetch_at[0] = next_t - TELEMETRY_LEAD
 
     except KeyboardInterrupt:
         print('Stopped plotting.')
     finally:
-        plt.ioff()
+        if os.name == 'nt':
+            ctypes.windll.winmm.timeEndPeriod(1)
+        stop_event.set()
+        producer.join(timeout=1.0)
+        fig.canvas.mpl_disconnect(draw_cid)
+        update_trajectory()  # last samples may not have been rendered yet
         # Save final 3D figure PNG
         fig_path = os.path.join(out_dir, 'trajectory_3d.png')
         try:
@@ -187,10 +329,18 @@ def main():
         plt.close(fig)
 
         # ---------- Save time-series plots ----------
-        if len(t_list) >= 2:
+        # Zero-copy views over the valid part of the sample buffers (no per-float boxing below)
+        t_list = t_arr[:n]
+        xs = pts[:n, 0]
+        ys = pts[:n, 1]
+        z_plot = pts[:n, 2]
+        if n >= 2:
+            # One figure reused for all time-series plots (cleared per plot)
+            fig_ts, ax_ts = plt.subplots(figsize=(8, 4))
+
             # Positions over time
             def save_ts(title, ys_data, ylabel, fname):
-                fig_ts, ax_ts = plt.subplots(figsize=(8, 4))
+                ax_ts.cla()
                 ax_ts.set_title(title)
                 ax_ts.set_xlabel('Time (s)')
                 ax_ts.set_ylabel(ylabel)
@@ -198,7 +348,6 @@ def main():
                 ax_ts.plot(t_list, ys_data, 'b-')
                 out_path = os.path.join(out_dir, fname)
                 fig_ts.savefig(out_path, dpi=150, bbox_inches='tight')
-                plt.close(fig_ts)
                 print(f'Saved: {out_path}')
 
             save_ts('X vs Time', xs, 'X (m)', 'x_time.png')
@@ -207,16 +356,19 @@ def main():
             save_ts('Z (ENU) vs Time', z_plot, 'Z (m, ENU)', 'z_time.png')
 
             # Attitude angles vs time (degrees)
-            rolls_deg = np.degrees(np.unwrap(rolls))
-            pitches_deg = np.degrees(np.unwrap(pitches))
-            yaws_deg = np.degrees(np.unwrap(yaws))
+            rolls_deg, pitches_deg, yaws_deg = quat_array_to_rpy_deg(quats[:n])
             save_ts('Roll vs Time', rolls_deg, 'Roll (deg)', 'roll_time.png')
             save_ts('Pitch vs Time', pitches_deg, 'Pitch (deg)', 'pitch_time.png')
             save_ts('Yaw vs Time', yaws_deg, 'Yaw (deg)', 'yaw_time.png')
+            plt.close(fig_ts)
 
             # ---------- Save 2D projections (use ENU z) ----------
+            # One figure reused for all projections; fully cleared per plot to drop the colorbar
+            fig2d = plt.figure(figsize=(6, 6))
+
             def save_2d(title, x_data, y_data, xlabel, ylabel, fname, t_list_local):
-                fig2d, ax2d = plt.subplots(figsize=(6, 6))
+                fig2d.clear()
+                ax2d = fig2d.add_subplot(111)
                 ax2d.set_title(title)
                 ax2d.set_xlabel(xlabel)
                 ax2d.set_ylabel(ylabel)
@@ -224,10 +376,9 @@ def main():
                 from matplotlib.collections import LineCollection
                 if len(x_data) > 1:
                     pts2d = np.column_stack([x_data, y_data])
-                    segments2d = np.concatenate([pts2d[:-1, None, :], pts2d[1:, None, :]], axis=1)
+                    segments2d = np.stack([pts2d[:-1], pts2d[1:]], axis=1)
                     lc2d = LineCollection(segments2d, cmap=cm.plasma, linewidth=2)
-                    seg_times2d = np.array(t_list_local[1:])
-                    lc2d.set_array(seg_times2d)
+                    lc2d.set_array(t_list_local[1:])
                     lc2d.set_norm(mcolors.Normalize(vmin=0.0, vmax=max(1e-6, t_list_local[-1])))
                     ax2d.add_collection(lc2d)
                     cb2 = fig2d.colorbar(lc2d, ax=ax2d)
@@ -235,36 +386,35 @@ def main():
                 # autoscale with equal aspect
                 if len(x_data) > 0:
                     margin = 1.5
-                    xmin, xmax = min(x_data) - margin, max(x_data) + margin
-                    ymin, ymax = min(y_data) - margin, max(y_data) + margin
+                    xmin, xmax = x_data.min() - margin, x_data.max() + margin
+                    ymin, ymax = y_data.min() - margin, y_data.max() + margin
                     ax2d.set_xlim(xmin, xmax)
                     ax2d.set_ylim(ymin, ymax)
                     # set equal aspect
                     ax2d.set_aspect('equal', adjustable='box')
                 out_path = os.path.join(out_dir, fname)
                 fig2d.savefig(out_path, dpi=150, bbox_inches='tight')
-                plt.close(fig2d)
                 print(f'Saved: {out_path}')
 
             save_2d('XY Plane', xs, ys, 'X (m)', 'Y (m)', 'xy.png', t_list)
             save_2d('YZ Plane', ys, z_plot, 'Y (m)', 'Z (m, ENU)', 'yz.png', t_list)
             save_2d('XZ Plane', xs, z_plot, 'X (m)', 'Z (m, ENU)', 'xz.png', t_list)
+            plt.close(fig2d)
         else:
             print('Not enough samples to create time-series and projections.')
 
         # ---------- Save GIF ----------
-        if IMAGEIO_AVAILABLE and len(frames) > 0:
-            gif_path = os.path.join(out_dir, 'trajectory_3d.gif')
+        if gif_writer is not None:
             try:
-                base_fps = max(1, int(round(1/DT)))
-                imageio.mimsave(gif_path, frames, fps=base_fps * GIF_SPEED_MULTIPLIER)  # 3x speed
-                print(f'Saved GIF: {gif_path} (fps={base_fps * GIF_SPEED_MULTIPLIER})')
+                gif_writer.close()
+                if gif_frames > 0:
+                    print(f'Saved GIF: {gif_path} (fps={gif_fps}, {GIF_SPEED_MULTIPLIER}x speed)')
+                else:
+                    print('No frames captured. GIF is empty.')
             except Exception as e:
                 print('Failed to save GIF:', e)
         elif not IMAGEIO_AVAILABLE:
             print('imageio not installed. Install with: pip install imageio')
-        else:
-            print('No frames captured. GIF not saved.')
 
     # Optional: disable API control at end (commented to keep control outside)
     # client.armDisarm(False, vehicle_name=LEADER_NAME)